@@ -17,28 +17,41 @@
 # https://github.com/elesiuta/baka
 
 import argparse
-import datetime
-import email
-import email.mime.text
+import codecs
 import functools
 import hashlib
 import json
 import os
+import re
 import shlex
 import shutil
-import smtplib
+import signal
 import socket
+import stat
 import subprocess
 import sys
+import threading
 import time
 import typing
 
-import argcomplete
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __version__: typing.Final[str] = "0.9.3"
 BASE_PATH: typing.Final[str] = os.path.expanduser("~/.baka")
+COMMENT_LINE: typing.Final[re.Pattern] = re.compile(r"^\s*(?:#|//).*$", re.MULTILINE)
+# resolved once at import, before main changes the working directory
+HASH_AND_COPY_FILES: typing.Final[tuple[str, ...]] = (sys.executable, os.path.abspath(__file__), "--_hash_and_copy_files")
+GIT_ADD_ALL: typing.Final[tuple[str, ...]] = ("git", "add", "--ignore-errors", "--all")
+GIT_LOG: typing.Final[tuple[str, ...]] = (
+    "git", "log", "--abbrev-commit", "--all", "--decorate", "--graph", "--stat",
+    "--format=format:%C(bold blue)%h%C(reset) - %C(bold cyan)%aD%C(reset) %C(bold green)(%ar)%C(reset)%C(bold yellow)%d%C(reset)%n%C(bold white)%s%C(reset)%C(dim white) - %an%C(reset)"
+)
 
 
+@functools.lru_cache(maxsize=1)
 def init_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="the stupid configuration tracker using the stupid content tracker",
                                      usage="%(prog)s [--dry-run] <argument>")
@@ -88,10 +101,58 @@ def init_parser() -> argparse.ArgumentParser:
                         help="supplies 'y' to job commands, similar to yes | job")
     parser.add_argument("-n", "--dry-run", dest="dry_run", action="store_true",
                         help="print commands instead of executing them")
-    argcomplete.autocomplete(parser)
+    # argcomplete only does anything when the shell is asking for completions, skip importing it otherwise
+    if "_ARGCOMPLETE" in os.environ:
+        import argcomplete
+        argcomplete.autocomplete(parser)
     return parser
 
 
+def open_text(file_path: str, mode: str = "r") -> typing.TextIO:
+    # every text file baka reads or writes is utf-8, undecodable bytes round trip instead of raising
+    return open(file_path, mode, encoding="utf-8", errors="surrogateescape")
+
+
+def json_loads(text: str) -> typing.Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # orjson rejects surrogate escaped text, fall back to json which also raises the usual error for bad json
+            pass
+    return json.loads(text)
+
+
+def json_dumps(obj: typing.Any, sort_keys: bool = True) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | (orjson.OPT_SORT_KEYS if sort_keys else 0)).decode("utf-8")
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, indent=2, separators=(',', ': '), sort_keys=sort_keys, ensure_ascii=False)
+
+
+def write_json_if_changed(file_path: str, obj: typing.Any) -> None:
+    # leave unchanged files untouched so git add can skip them by their stat info instead of hashing them again
+    text = json_dumps(obj)
+    try:
+        with open_text(file_path) as json_file:
+            if json_file.read() == text:
+                return
+    except FileNotFoundError:
+        pass
+    with open_text(file_path, "w") as json_file:
+        json_file.write(text)
+
+
+@functools.lru_cache(maxsize=4)
+def load_config_json(config_path: str, mtime_ns: int) -> dict:
+    # mtime_ns is only part of the cache key so edits are picked up, the returned dict is shared so do not modify it
+    with open_text(config_path) as json_file:
+        # remove comments from json file, lines starting with # or //
+        return json_loads(COMMENT_LINE.sub("", json_file.read()))
+
+
 class Config:
     def __init__(self):
         # default config
@@ -130,11 +191,13 @@ class Config:
                 },
                 "exit_non_zero": False,
                 "interactive": False,
+                "parallel": False,
                 "shlex_split": False,
                 "verbosity": "one of: debug (default if null), info, error, silent",
                 "write": "./jobs/example job %Y-%m-%d %H:%M.log (supports strftime format codes) or null"
             }
         }
+        self.log_limit = 200
         self.system_checks = {
             "ip_rules_v4": "sudo cat /etc/iptables/rules.v4",
             "ip_rules_v6": "sudo cat /etc/iptables/rules.v6",
@@ -152,97 +215,191 @@ class Config:
             "lynis": "sudo lynis audit system",
             "rkhunter": "sudo rkhunter --check --skip-keypress",
         }
-        self.tracked_paths = {k: v for k, v in {
-            "/etc": {"max_size": 128000},
-            os.path.expanduser("~"): {"max_depth": 2, "max_size": 128000, "path_starts_with": ".", "exclude": [".ssh"]},
-            os.path.expanduser("~/.config"): {"max_depth": 2, "max_size": 128000, "exclude": ["log", "Local State", "TransportSecurity"]},
-            os.path.expanduser("~/.kde/share"): {"max_depth": 3, "max_size": 128000},
-            os.path.expanduser("~/.local/share"): {"max_depth": 3, "max_size": 128000, "exclude": ["application_state"]},
-        }.items() if os.path.exists(k)}
+        # the default tracked paths check which folders exist, so they are only filled in below if config.json does not set them
+        self.tracked_paths = None
         # read config file and set values, or write if it does not exist
         config_path = os.path.join(BASE_PATH, "config.json")
-        if os.path.exists(config_path):
-            with open(config_path, "r", encoding="utf-8", errors="surrogateescape") as json_file:
-                # remove comments from json file
-                raw_text = json_file.readlines()
-                for i in reversed(range(len(raw_text))):
-                    if raw_text[i].lstrip().startswith("#"):
-                        _ = raw_text.pop(i)
-                    elif raw_text[i].lstrip().startswith("//"):
-                        _ = raw_text.pop(i)
-                config = json.loads("".join(raw_text))
-            for key in config:
-                if config[key] is not None and hasattr(self, key):
-                    self.__setattr__(key, config[key])
-            for tracked_path in self.tracked_paths:
+        try:
+            config_mtime_ns = os.stat(config_path).st_mtime_ns
+        except FileNotFoundError:
+            config_mtime_ns = None
+        if config_mtime_ns is not None:
+            config = load_config_json(config_path, config_mtime_ns)
+            # only keys that have a default are taken from the file, in a single update instead of hasattr/setattr per key
+            self.__dict__.update({key: value for key, value in config.items() if value is not None and key in self.__dict__})
+            for tracked_path in self.tracked_paths or {}:
                 assert os.path.isabs(tracked_path)
-        else:
-            if not os.path.isdir(os.path.dirname(config_path)):
-                os.makedirs(os.path.dirname(config_path))
-            with open(config_path, "w", encoding="utf-8", errors="surrogateescape") as json_file:
-                json.dump(vars(self), json_file, indent=2, separators=(',', ': '), sort_keys=True, ensure_ascii=False)
+            # --log formats this as a number, a quoted "200" in config.json should still work
+            self.log_limit = int(self.log_limit)
+        if self.tracked_paths is None:
+            home = os.path.expanduser("~")
+            self.tracked_paths = {k: v for k, v in {
+                "/etc": {"max_size": 128000},
+                home: {"max_depth": 2, "max_size": 128000, "path_starts_with": ".", "exclude": [".ssh"]},
+                os.path.join(home, ".config"): {"max_depth": 2, "max_size": 128000, "exclude": ["log", "Local State", "TransportSecurity"]},
+                os.path.join(home, ".kde", "share"): {"max_depth": 3, "max_size": 128000},
+                os.path.join(home, ".local", "share"): {"max_depth": 3, "max_size": 128000, "exclude": ["application_state"]},
+            }.items() if os.path.exists(k)}
+        if config_mtime_ns is None:
+            os.makedirs(os.path.dirname(config_path), exist_ok=True)
+            # "x" only creates the file, an existing config is never overwritten
+            with open_text(config_path, "x") as json_file:
+                # keep the defaults in the order they are written above, no need to sort them
+                json_file.write(json_dumps(vars(self), sort_keys=False))
         # get the system hostname, usually /etc/hostname but can override with .baka/hostname (not in config.json or committed)
-        if os.path.exists(os.path.join(BASE_PATH, "hostname")):
-            with open(os.path.join(BASE_PATH, "hostname"), "r") as f:
+        try:
+            with open_text(os.path.join(BASE_PATH, "hostname")) as f:
                 self.hostname = f.read().strip()
-        else:
+        except FileNotFoundError:
             self.hostname = socket.gethostname()
+        # where each tracked path is mirrored under ~/.baka (derived, so not written to config.json)
+        self.tracked_mirrors = {tracked_path: BASE_PATH + tracked_path for tracked_path in self.tracked_paths}
 
 
 def os_stat_tracked_files(config: "Config") -> None:
-    stat = {}
-    for tracked_path in list(config.tracked_paths):
+    stats = {}
+    for tracked_path, mirror_path in config.tracked_mirrors.items():
         if os.path.isdir(tracked_path):
-            for root, dirs, files in os.walk(BASE_PATH + tracked_path, followlinks=False):
-                for file_or_folder in files + dirs:
-                    file_path = "/" + os.path.relpath(os.path.join(root, file_or_folder), BASE_PATH)
-                    if os.path.exists(file_path):
+            for root, dirs, files in walk(mirror_path):
+                for entry in files + dirs:
+                    # the mirror is always under BASE_PATH, so slicing gives the same path as relpath without normalizing it again
+                    file_path = entry.path[len(BASE_PATH):]
+                    # a single stat instead of checking exists first, anything that cannot be stat'ed was skipped by exists too
+                    try:
                         file_stat = os.stat(file_path)
-                        stat[file_path] = {"mode": oct(file_stat.st_mode), "uid": file_stat.st_uid, "gid": file_stat.st_gid}
+                    except OSError:
+                        continue
+                    stats[file_path] = {"mode": oct(file_stat.st_mode), "uid": file_stat.st_uid, "gid": file_stat.st_gid}
         elif os.path.isfile(tracked_path):
             file_path = tracked_path
-            if os.path.exists(BASE_PATH + file_path):
+            if os.path.exists(mirror_path):
                 file_stat = os.stat(file_path)
-                stat[file_path] = {"mode": oct(file_stat.st_mode), "uid": file_stat.st_uid, "gid": file_stat.st_gid}
-    with open(os.path.join(BASE_PATH, "stat.json"), "w", encoding="utf-8", errors="surrogateescape") as json_file:
-        json.dump(stat, json_file, indent=2, separators=(',', ': '), sort_keys=True, ensure_ascii=False)
+                stats[file_path] = {"mode": oct(file_stat.st_mode), "uid": file_stat.st_uid, "gid": file_stat.st_gid}
+    write_json_if_changed(os.path.join(BASE_PATH, "stat.json"), stats)
 
 
-def hash_and_copy_files(config: "Config") -> None:
-    # also keep track of hashes, need to read the files anyways and can save on writes
-    new_hashes = {}
-    old_hashes = {}
+def walk(top: str) -> typing.Iterator[tuple[str, list[os.DirEntry], list[os.DirEntry]]]:
+    # like os.walk(top, followlinks=False) but yields the DirEntry objects so callers can reuse their cached type info
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        dirs, files = [], []
+        try:
+            with os.scandir(root) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    (dirs if is_dir else files).append(entry)
+        except OSError:
+            continue
+        # dirs can be pruned in place by the caller before descending
+        yield root, dirs, files
+        stack.extend(reversed([d.path for d in dirs if not d.is_symlink()]))
+
+
+def hash_and_copy_file(file_path: str, is_symlink: bool, conditions: dict, old_hash: str, created_dirs: set[str]) -> tuple[typing.Optional[str], typing.Optional[str]]:
+    # returns the new hash (None if it could not be read) and the reason the file was omitted (None if it was not)
+    new_hash = None
+    omitted = None
+    try:
+        if is_symlink:
+            omitted = f"islink: {os.path.realpath(file_path)}"
+        file_stat = os.stat(file_path)
+        if conditions["max_size"] and file_stat.st_size > conditions["max_size"]:
+            return None, "max_size"
+        copy_path = BASE_PATH + file_path
+        # quick check like rsync, the copy has the same mtime as its source so if size and mtime match it is assumed unchanged
+        if old_hash:
+            try:
+                copy_stat = os.stat(copy_path)
+                if copy_stat.st_size == file_stat.st_size and copy_stat.st_mtime_ns == file_stat.st_mtime_ns:
+                    return old_hash, omitted
+            except FileNotFoundError:
+                pass
+        with open(file_path, "rb") as f:
+            # let the kernel read ahead on large files, they are read start to end once
+            if file_stat.st_size > 1 << 20 and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if conditions["test_utf_readable"]:
+                # decode the first chunk like a text mode read(1) would, without opening the file twice
+                codecs.getincrementaldecoder("utf-8")().decode(f.read(8192))
+                f.seek(0)
+            # hash in fixed size chunks without holding the whole file in memory
+            if hasattr(hashlib, "file_digest"):
+                new_hash = hashlib.file_digest(f, "sha256").hexdigest()
+            else:
+                digest = hashlib.sha256()
+                buffer = memoryview(bytearray(min(file_stat.st_size, 1 << 18) or 1))
+                while size := f.readinto(buffer):
+                    digest.update(buffer[:size])
+                new_hash = digest.hexdigest()
+        # all conditions met, copy file if changed
+        if new_hash == old_hash:
+            return new_hash, omitted
+        # dest might be readonly since permissions are copied, temporarily make it writable
+        try:
+            if not stat.S_ISLNK(os.lstat(copy_path).st_mode):
+                os.chmod(copy_path, 0o200)
+        except FileNotFoundError:
+            copy_dir = os.path.dirname(copy_path)
+            if copy_dir not in created_dirs:
+                # another thread may be creating the same folder
+                os.makedirs(copy_dir, exist_ok=True)
+                created_dirs.add(copy_dir)
+        # copyfile lets the kernel copy the data (sendfile) instead of passing it through python
+        shutil.copyfile(file_path, copy_path)
+        # only copy times and mode (like rsync -tp), copystat would stat again and copy xattrs and flags
+        os.utime(copy_path, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns))
+        os.chmod(copy_path, file_stat.st_mode & 0o7777)
+    except Exception as e:
+        omitted = type(e).__name__
+    return new_hash, omitted
+
+
+def hash_and_copy_tracked_paths(config: "Config", tracked_paths: list[str], old_hashes: dict, executor: "concurrent.futures.Executor", created_dirs: set[str]) -> tuple[dict, dict]:
+    # walk the tracked paths and hand each file that meets the conditions to the executor to be hashed and copied
+    futures = {}
     omitted = {}
-    if os.path.exists(os.path.join(BASE_PATH, "sha256.json")):
-        with open(os.path.join(BASE_PATH, "sha256.json"), "r", encoding="utf-8", errors="surrogateescape") as json_file:
-            old_hashes = json.load(json_file)
-    for tracked_path in config.tracked_paths:
+    # every file the walk finds exists, so the cleanup below only has to check the ones it did not reach
+    seen = set()
+    for tracked_path in tracked_paths:
         # set default values (no conditions) and load conditions for which files to track/copy
         conditions = {"exclude": [], "include": [], "file_starts_with": "", "path_starts_with": "", "max_depth": None, "max_size": None, "test_utf_readable": True}
         for condition in config.tracked_paths[tracked_path]:
             conditions[condition] = config.tracked_paths[tracked_path][condition]
-        for root, dirs, files in os.walk(tracked_path, followlinks=False):
+        # match all excludes (or includes) as substrings with one regex search per file
+        exclude = re.compile("|".join(map(re.escape, conditions["exclude"]))) if conditions["exclude"] else None
+        include = re.compile("|".join(map(re.escape, conditions["include"]))) if conditions["include"] else None
+        # every path the walk yields starts with the tracked path, so relative paths are a slice instead of os.path.relpath
+        prefix_len = len(os.path.join(tracked_path, ""))
+        for root, dirs, files in walk(tracked_path):
             # check conditions
-            relpath = os.path.relpath(root, tracked_path)
+            relpath = root[prefix_len:] or "."
             # ~/.baka is a subfolder of the path to track
             if root.startswith(BASE_PATH):
-                del dirs
+                dirs.clear()
                 continue
             if conditions["path_starts_with"] and not relpath.startswith(conditions["path_starts_with"]):
                 omitted[root] = "path_starts_with"
-                del dirs
+                # only keep walking subfolders that could still lead to a match
+                dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(relpath, d.name)).startswith(conditions["path_starts_with"]) or
+                           conditions["path_starts_with"].startswith(os.path.normpath(os.path.join(relpath, d.name)))]
                 continue
             if conditions["max_depth"] and relpath.count("/") > conditions["max_depth"]:
                 omitted[root] = "max_depth"
-                del dirs
+                dirs.clear()
                 continue
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_relpath = os.path.relpath(file_path, tracked_path)
-                if conditions["exclude"] and any(e in file_relpath for e in conditions["exclude"]):
+            for entry in files:
+                file = entry.name
+                file_path = entry.path
+                seen.add(file_path)
+                file_relpath = file_path[prefix_len:]
+                if exclude and exclude.search(file_relpath):
                     omitted[file_path] = "exclude"
                     continue
-                if conditions["include"] and not any(i in file_relpath for i in conditions["include"]):
+                if include and not include.search(file_relpath):
                     omitted[file_path] = "include"
                     continue
                 if conditions["file_starts_with"] and not file.startswith(conditions["file_starts_with"]):
@@ -251,72 +408,189 @@ def hash_and_copy_files(config: "Config") -> None:
                 if conditions["path_starts_with"] and not file_relpath.startswith(conditions["path_starts_with"]):
                     omitted[file_path] = "path_starts_with"
                     continue
-                try:
-                    if os.path.islink(file_path):
-                        omitted[file_path] = f"islink: {os.path.realpath(file_path)}"
-                    if conditions["max_size"] and os.stat(file_path).st_size > conditions["max_size"]:
-                        omitted[file_path] = "max_size"
-                        continue
-                    if conditions["test_utf_readable"]:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            _ = f.read(1)
-                    # all conditions met, hash and copy file if changed
-                    copy_path = BASE_PATH + file_path
-                    with open(file_path, "rb") as f:
-                        file_contents = f.read()
-                        new_hash = hashlib.sha256(file_contents).hexdigest()
-                        new_hashes[file_path] = new_hash
-                    if new_hash == old_hashes.get(file_path, ""):
-                        continue
-                    # dest might be readonly since permissions are copied, temporarily make it writable
-                    if os.path.exists(copy_path) and not os.path.islink(copy_path):
-                        os.chmod(copy_path, 0o200)
-                    elif not os.path.isdir(os.path.dirname(copy_path)):
-                        os.makedirs(os.path.dirname(copy_path))
-                    with open(copy_path, "wb") as f:
-                        f.write(file_contents)
-                    shutil.copystat(file_path, copy_path)
-                    del file_contents
-                except Exception as e:
-                    omitted[file_path] = type(e).__name__
-        # remove copies of tracked files that no longer exist on system
-        for root, dirs, files in os.walk(BASE_PATH + tracked_path, followlinks=False):
-            for file in files:
-                if not os.path.exists("/" + os.path.relpath(os.path.join(root, file), BASE_PATH)):
-                    if not os.path.islink(os.path.join(root, file)):
-                        os.chmod(os.path.join(root, file), 0o200)
-                    os.remove(os.path.join(root, file))
+                # already copied while walking a parent tracked path, only try again with these conditions if that failed
+                if file_path in futures and futures[file_path].result()[0] is not None:
+                    continue
+                futures[file_path] = executor.submit(hash_and_copy_file, file_path, entry.is_symlink(), conditions, old_hashes.get(file_path, ""), created_dirs)
+        # remove copies of tracked files that no longer exist on system, nested paths are covered by their parent
+        if any(p != tracked_path and tracked_path.startswith(os.path.join(p, "")) for p in tracked_paths):
+            continue
+        for root, dirs, files in walk(config.tracked_mirrors[tracked_path]):
+            for entry in files:
+                file_path = entry.path[len(BASE_PATH):]
+                if file_path not in seen and not os.path.exists(file_path):
+                    if not entry.is_symlink():
+                        os.chmod(entry.path, 0o200)
+                    os.remove(entry.path)
+    new_hashes = {}
+    for file_path, future in futures.items():
+        new_hash, reason = future.result()
+        if new_hash is not None:
+            new_hashes[file_path] = new_hash
+        if reason is not None:
+            omitted[file_path] = reason
+    return new_hashes, omitted
+
+
+def hash_and_copy_files(config: "Config") -> None:
+    # also keep track of hashes, need to read the files anyways and can save on writes
+    new_hashes = {}
+    old_hashes = {}
+    omitted = {}
+    if os.path.exists(os.path.join(BASE_PATH, "sha256.json")):
+        with open_text(os.path.join(BASE_PATH, "sha256.json")) as json_file:
+            old_hashes = json_loads(json_file.read())
+    # mirror folders known to exist this run, so each new file in them skips makedirs
+    created_dirs = set()
+    # tracked paths are walked in parallel, nested paths are grouped with their parent so no file is copied twice
+    groups = {}
+    for tracked_path in config.tracked_paths:
+        parents = [p for p in config.tracked_paths if p != tracked_path and tracked_path.startswith(os.path.join(p, ""))]
+        groups.setdefault(min(parents, key=len, default=tracked_path), []).append(tracked_path)
+    # files are hashed and copied in a shared pool, reading and hashing release the GIL so threads overlap the I/O
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor() as file_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max(len(groups), 1)) as executor:
+        futures = [executor.submit(hash_and_copy_tracked_paths, config, group, old_hashes, file_executor, created_dirs) for group in groups.values()]
+        for future in futures:
+            group_hashes, group_omitted = future.result()
+            new_hashes.update(group_hashes)
+            omitted.update(group_omitted)
     # write new hashes and omitted files with reasons
-    with open(os.path.join(BASE_PATH, "sha256.json"), "w", encoding="utf-8", errors="surrogateescape") as json_file:
-        json.dump(new_hashes, json_file, indent=2, separators=(',', ': '), sort_keys=True, ensure_ascii=False)
-    with open(os.path.join(BASE_PATH, "omitted.json"), "w", encoding="utf-8", errors="surrogateescape") as json_file:
-        json.dump(omitted, json_file, indent=2, separators=(',', ': '), sort_keys=True, ensure_ascii=False)
+    write_json_if_changed(os.path.join(BASE_PATH, "sha256.json"), new_hashes)
+    write_json_if_changed(os.path.join(BASE_PATH, "omitted.json"), omitted)
 
 
-def copy_and_git_add_all() -> list[list[str]]:
+def copy_and_git_add_all() -> list[typing.Sequence[str]]:
     cmds = [
-        [sys.executable, os.path.abspath(__file__), "--_hash_and_copy_files"],
-        ["git", "add", "--ignore-errors", "--all"]
+        HASH_AND_COPY_FILES,
+        GIT_ADD_ALL
     ]
     return cmds
 
 
-def send_email(config_email: dict, job_email: dict, body: str) -> int:
-    message = email.message.EmailMessage()
-    message["From"] = config_email["from"]
-    message["To"] = job_email["to"]
-    if config_email["cc"]:
-        message["Cc"] = config_email["cc"]
-    message["Subject"] = job_email["subject"]
-    if config_email["html"]:
-        body = email.mime.text.MIMEText("<pre>" + body + "</pre>", "html")
-    message.set_content(body)
-    with smtplib.SMTP(config_email["smtp_server"], int(config_email["smtp_port"])) as smtp_server_instance:
+def run_command(cmd: typing.Sequence[str]) -> subprocess.CompletedProcess:
+    # commands that inherit stdio can skip Popen and be spawned and waited on directly
+    if hasattr(os, "posix_spawnp"):
+        # python ignores SIGPIPE and SIGXFSZ, restore their defaults in the child like subprocess does
+        pid = os.posix_spawnp(cmd[0], cmd, os.environ, setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        return subprocess.CompletedProcess(cmd, os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]))
+    return subprocess.run(cmd)
+
+
+def run_and_capture(cmd: list[str], proc_input: typing.Optional[bytes], show_stdout: bool, show_stderr: bool) -> subprocess.CompletedProcess:
+    # drain both pipes while the command runs so its output can be shown as it arrives instead of when it exits
+    def drain(pipe: typing.BinaryIO, chunks: list[bytes], tee: typing.Optional[typing.BinaryIO]) -> None:
+        for chunk in iter(functools.partial(pipe.read1, 65536), b""):
+            chunks.append(chunk)
+            if tee is not None:
+                tee.write(chunk)
+                tee.flush()
+        pipe.close()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout, stderr = [], []
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if proc_input else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    threads = [
+        threading.Thread(target=drain, args=(proc.stdout, stdout, sys.stdout.buffer if show_stdout else None)),
+        threading.Thread(target=drain, args=(proc.stderr, stderr, sys.stderr.buffer if show_stderr else None))
+    ]
+    for thread in threads:
+        thread.start()
+    if proc_input:
+        try:
+            proc.stdin.write(proc_input)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    for thread in threads:
+        thread.join()
+    return subprocess.CompletedProcess(cmd, proc.wait(), b"".join(stdout), b"".join(stderr))
+
+
+class SMTPPool:
+    # servers commonly limit messages per connection, so start a new one before hitting that
+    max_messages = 100
+    # temporary failures (service unavailable, mailbox busy, local error) are retried with backoff, permanent 5xx are not
+    retry_codes = (421, 450, 451)
+    retries = 3
+
+    def __init__(self):
+        # one logged in connection per (server, port, username), reused for every message sent this run
+        self.connections = {}
+        self.sent = {}
+
+    def __enter__(self) -> "SMTPPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def connect(self, config_email: dict) -> "smtplib.SMTP":
+        # smtplib, email and datetime are only imported when needed, most runs never send email
+        import smtplib
+        key = (config_email["smtp_server"], int(config_email["smtp_port"]), config_email["smtp_username"])
+        if key in self.connections:
+            # the server may have dropped the connection since the last message
+            try:
+                if self.sent[key] < self.max_messages and self.connections[key].noop()[0] == 250:
+                    return self.connections[key]
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close_connection(key)
+        smtp_server_instance = smtplib.SMTP(key[0], key[1])
         smtp_server_instance.ehlo()
         smtp_server_instance.starttls()
         smtp_server_instance.login(config_email["smtp_username"], config_email["smtp_password"])
-        smtp_server_instance.send_message(message)
-    return 0
+        self.connections[key] = smtp_server_instance
+        self.sent[key] = 0
+        return smtp_server_instance
+
+    def send(self, config_email: dict, job_email: dict, body: str) -> int:
+        import email.message
+        import email.mime.text
+        import smtplib
+        message = email.message.EmailMessage()
+        message["From"] = config_email["from"]
+        message["To"] = job_email["to"]
+        if config_email["cc"]:
+            message["Cc"] = config_email["cc"]
+        message["Subject"] = job_email["subject"]
+        if config_email["html"]:
+            body = email.mime.text.MIMEText("<pre>" + body + "</pre>", "html")
+        message.set_content(body)
+        key = (config_email["smtp_server"], int(config_email["smtp_port"]), config_email["smtp_username"])
+        for attempt in range(self.retries + 1):
+            try:
+                self.connect(config_email).send_message(message)
+                self.sent[key] += 1
+                return 0
+            except smtplib.SMTPServerDisconnected:
+                # dropped between the health check and sending, the next connect will log in again
+                if attempt == self.retries:
+                    raise
+            except smtplib.SMTPResponseException as e:
+                if e.smtp_code not in self.retry_codes or attempt == self.retries:
+                    raise
+                # the server may have closed the connection along with the error
+                self.close_connection(key)
+                time.sleep(2 ** attempt)
+        return 0
+
+    def close_connection(self, key: tuple) -> None:
+        import smtplib
+        smtp_server_instance = self.connections.pop(key, None)
+        self.sent.pop(key, None)
+        if smtp_server_instance is not None:
+            try:
+                smtp_server_instance.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp_server_instance.close()
+
+    def close(self) -> None:
+        for key in list(self.connections):
+            self.close_connection(key)
 
 
 def main() -> int:
@@ -329,8 +603,8 @@ def main() -> int:
     # parse arguments
     parser = init_parser()
     args = parser.parse_args()
-    # init config
-    config = Config()
+    # init config, except for commands that only run git in the repo and never read it
+    config = None if (args.push or args.pull or args.untrack or args.show) else Config()
     # change cwd to repo folder
     original_cwd = os.getcwd()
     os.chdir(BASE_PATH)
@@ -354,7 +628,8 @@ def main() -> int:
         cmds = [
             ["git", "init"],
             ["git", "config", "user.name", "baka admin"],
-            ["git", "config", "user.email", "baka@" + config.hostname],
+            ["git", "config", "user.email", f"baka@{config.hostname}"],
+            ["git", "config", "core.untrackedCache", "true"],
             ["touch", "error.log"],
             ["bash", "-c", "echo '"
                 "history.log\n"
@@ -382,17 +657,13 @@ def main() -> int:
             ["nano", os.path.join(BASE_PATH, ".gitignore")],
             ["bash", "-c", "read -p 'Press enter to add files to repository'"],
             *copy_and_git_add_all(),
-            ["mkdir", "-p", "docker"],
-            ["mkdir", "-p", "ignore"],
-            ["mkdir", "-p", "scripts"],
-            ["mkdir", "-p", "syscks"],
-            ["mkdir", "-p", "scans"],
+            ["mkdir", "-p", "docker", "ignore", "scripts", "syscks", "scans"],
             ["git", "commit", "-m", "baka initial commit"]
         ]
     elif args.commit:
         cmds = [
             *copy_and_git_add_all(),
-            ["git", "commit", "-m", "baka commit " + args.commit]
+            ["git", "commit", "-m", f"baka commit {args.commit}"]
         ]
     elif args.push:
         cmds = [
@@ -415,7 +686,7 @@ def main() -> int:
             ["git", "rm", "-r", "--cached", *paths],
             ["bash", "-c", "echo \"\n# baka untrack\n%s\" >> .gitignore" % "\n".join(paths)],
             ["git", "add", ".gitignore"],
-            ["git", "commit", "-m", "baka untrack %s" % " ".join(paths)]
+            ["git", "commit", "-m", f"baka untrack {shlex.join(paths)}"]
         ]
     elif args.install:
         cmds = [
@@ -423,7 +694,7 @@ def main() -> int:
             ["git", "commit", "-m", "baka pre-install"],
             config.cmd_install + args.install,
             *copy_and_git_add_all(),
-            ["git", "commit", "-m", "baka install " + " ".join(args.install)]
+            ["git", "commit", "-m", f"baka install {shlex.join(args.install)}"]
         ]
     elif args.remove is not None:
         cmds = [
@@ -431,7 +702,7 @@ def main() -> int:
             ["git", "commit", "-m", "baka pre-remove"],
             config.cmd_remove + args.remove,
             *copy_and_git_add_all(),
-            ["git", "commit", "-m", "baka remove " + " ".join(args.remove)]
+            ["git", "commit", "-m", f"baka remove {shlex.join(args.remove)}"]
         ]
     elif args.upgrade:
         cmds = [
@@ -448,7 +719,10 @@ def main() -> int:
         compose_arg = "up -d" if args.docker[0] == "up" else args.docker[0]
         cmds = []
         if args.docker[1] == "all":
-            for folder in sorted(os.listdir("docker")):
+            # scandir entries know if they are folders without another stat, stray files are not compose projects
+            with os.scandir("docker") as entries:
+                folders = sorted(entry.name for entry in entries if entry.is_dir())
+            for folder in folders:
                 if not os.path.exists(os.path.join("docker", folder, ".dockerignore")):
                     cmds.append(["bash", "-c", f"cd docker/{folder} && {compose_cmd} {compose_arg}"])
         else:
@@ -458,15 +732,15 @@ def main() -> int:
         assert args.file[0] in ["save", "restore", "s", "r"] and len(args.file) >= 2
         assert args.file[1] != "all" or (args.file[1] == "all" and len(args.file) == 2)
         try:
-            with open(os.path.join(BASE_PATH, f"stat_{config.hostname}.json"), "r", encoding="utf-8", errors="surrogateescape") as json_file:
-                file_stats = json.load(json_file)
+            with open_text(os.path.join(BASE_PATH, f"stat_{config.hostname}.json")) as json_file:
+                file_stats = json_loads(json_file.read())
         except:
             file_stats = {}
         file_list = config.files.keys() if args.file[1] == "all" else args.file[1:]
         cmds = []
         if config.files_pre_cmd:
             cmds.append(config.files_pre_cmd)
-        cmds.append(["git", "add", "--ignore-errors", "--all"])
+        cmds.append(GIT_ADD_ALL)
         cmds.append(["git", "commit", "-m", f"baka pre-file {config.hostname}"])
         current_os = "windows" if os.name == "nt" else "mac" if sys.platform == "darwin" else "linux"
         current_os_abbrev = current_os[0]
@@ -504,45 +778,56 @@ def main() -> int:
                         if src_file_path in file_stats:
                             cmds.append(["sudo", "chmod", file_stats[src_file_path]["mode"][2:], src_file_path])
                             cmds.append(["sudo", "chown", f"{file_stats[src_file_path]['uid']}:{file_stats[src_file_path]['gid']}", src_file_path])
-        cmds.append(["BAKA_STAT", json.dumps(file_stats, indent=2, separators=(',', ': '), sort_keys=True, ensure_ascii=False)])
-        cmds.append(["git", "add", "--ignore-errors", "--all"])
+        cmds.append(["BAKA_STAT", json_dumps(file_stats)])
+        cmds.append(GIT_ADD_ALL)
         cmds.append(["git", "commit", "-m", f"baka file {config.hostname}"])
         if config.files_post_cmd:
             cmds.append(config.files_post_cmd)
     elif args.job:
-        if args.interactive:
-            config.jobs[args.job]["interactive"] = True
         cmds = config.jobs[args.job]["commands"]
     elif args.list:
-        cmds = [
-            ["echo", "Email\tExit!0\tInter.\tVerb.\tWrite\tJob Name\n================================================"],
-            *[["echo", "%s\t%s\t%s\t%s\t%s\t%s" % (str(functools.reduce(lambda d, k : d.get(k) if isinstance(d, dict) and d.get(k) else False, ("email", "to"), config.jobs[job]))[:6],
-                                                   bool(config.jobs[job].get("exit_non_zero")),
-                                                   bool(config.jobs[job].get("interactive")),
-                                                   str(config.jobs[job].get("verbosity", "debug"))[:6],
-                                                   str(config.jobs[job].get("write", False))[:6],
-                                                   job)] for job in config.jobs]
-        ]
+        rows = ["Email\tExit!0\tInter.\tVerb.\tWrite\tJob Name\n================================================"]
+        for job in config.jobs:
+            job_email = config.jobs[job].get("email")
+            rows.append("%s\t%s\t%s\t%s\t%s\t%s" % (str((job_email.get("to") or False) if isinstance(job_email, dict) else False)[:6],
+                                                    bool(config.jobs[job].get("exit_non_zero")),
+                                                    bool(config.jobs[job].get("interactive")),
+                                                    str(config.jobs[job].get("verbosity", "debug"))[:6],
+                                                    str(config.jobs[job].get("write", False))[:6],
+                                                    job))
+        # the whole table in one echo instead of one process per job
+        cmds = [["echo", "\n".join(rows)]]
     elif args.system_checks:
         assert ("history" not in config.system_checks)
         assert all([key not in config.system_scans for key in config.system_checks])
+        # run all checks in parallel from one shell, each in a subshell so it behaves as if run alone, and exit with the number that failed
+        checks = " ".join("( %s > %s ) & pids+=($!);" % (config.system_checks[key], shlex.quote("syscks/%s.log" % key)) for key in config.system_checks)
         cmds = [
             *copy_and_git_add_all(),
             ["git", "commit", "-m", "baka pre-sysck"],
-            *[["bash", "-c", "%s > syscks/%s.log" % (config.system_checks[key], key)] for key in config.system_checks],
-            ["git", "add", "--ignore-errors", "--all"],
+            ["bash", "-c", "pids=(); %s failed=0; for pid in \"${pids[@]}\"; do wait \"$pid\" || failed=$((failed + 1)); done; exit $failed" % checks],
+            GIT_ADD_ALL,
             ["git", "commit", "-m", "baka sysck"]
         ]
+        # checks running at the same time should not all prompt for a sudo password, without a tty (cron) there is nobody to prompt
+        if sys.stdin.isatty() and any("sudo" in config.system_checks[key].split() for key in config.system_checks):
+            cmds.insert(2, ["sudo", "-v"])
     elif args.system_scans:
         assert ("history" not in config.system_scans)
         assert all([key not in config.system_checks for key in config.system_scans])
+        # run all scans in parallel like the checks, then show each log in order so their output does not interleave
+        scans = " ".join("( %s > %s ) & pids+=($!);" % (config.system_scans[key], shlex.quote("scans/%s.log" % key)) for key in config.system_scans)
+        logs = " ".join(shlex.quote("scans/%s.log" % key) for key in config.system_scans)
         cmds = [
             *copy_and_git_add_all(),
             ["git", "commit", "-m", "baka pre-scan"],
-            *[["bash", "-c", "%s | tee scans/%s.log" % (config.system_scans[key], key)] for key in config.system_scans],
-            ["git", "add", "--ignore-errors", "--all"],
+            ["bash", "-c", "pids=(); %s failed=0; for pid in \"${pids[@]}\"; do wait \"$pid\" || failed=$((failed + 1)); done; cat %s; exit $failed" % (scans, logs)],
+            GIT_ADD_ALL,
             ["git", "commit", "-m", "baka scan"]
         ]
+        # same as the checks, only prompt for sudo once up front when there is a tty to prompt on
+        if sys.stdin.isatty() and any("sudo" in config.system_scans[key].split() for key in config.system_scans):
+            cmds.insert(2, ["sudo", "-v"])
     elif args.diff:
         cmds = [
             *copy_and_git_add_all(),
@@ -550,45 +835,90 @@ def main() -> int:
             ["git", "diff", "--color-words", "--cached", "--minimal"]
         ]
     elif args.log:
-        cmds = [[
-            "git", "log", "--abbrev-commit", "--all", "--decorate", "--graph", "--stat",
-            "--format=format:%C(bold blue)%h%C(reset) - %C(bold cyan)%aD%C(reset) %C(bold green)(%ar)%C(reset)%C(bold yellow)%d%C(reset)%n%C(bold white)%s%C(reset)%C(dim white) - %an%C(reset)"
-        ]]
+        cmds = [list(GIT_LOG)]
+        # --stat makes git diff every commit it shows, so only walk the most recent ones (0 for all)
+        if config.log_limit:
+            cmds[0].insert(2, "--max-count=%d" % config.log_limit)
     elif args.show:
         cmds = [["git", "show", "--color-words"]]
     else:
         parser.print_usage()
         return 2
     # 2. Execute (or print if dry-run) commands
+    # log and show are a single git command with nothing to do afterwards, so let git replace this process
+    if (args.log or args.show) and not args.dry_run:
+        sys.stdout.flush()
+        os.execvp(cmds[0][0], cmds[0])
+    # job output is kept as bytes, it is only decoded if it needs to be emailed
     command_output = []
     error_message = ""
-    pending_stat = False
     return_code = 0
+    # config is cached and shared, so job modifiers are tracked here instead of written back to it
+    job_config = config.jobs[args.job] if args.job else {}
+    interactive = bool(args.job and (args.interactive or job_config.get("interactive")))
+    # the error message below names the current command, which is still unset if the dry-run print fails
+    cmd = []
     try:
-        for cmd in cmds:
-            if args.job and config.jobs[args.job].get("shlex_split", False):
+        if args.job and job_config.get("shlex_split", False):
+            split_cmds = []
+            for cmd in cmds:
                 if type(cmd) == list and len(cmd) == 1:
                     cmd = cmd[0]
-                cmd = shlex.split(cmd)
-            if args.dry_run:
-                print(shlex.join(cmd))
-                command_output.append("dry-run")
-                command_output.append(">>> " + shlex.join(cmd))
-                continue
-            # execute command if not dry-run
+                split_cmds.append(shlex.split(cmd))
+            cmds = split_cmds
+        if args.dry_run:
+            # nothing is run, print every command at once and keep them for the job output
+            cmd_strs = [shlex.join(cmd) for cmd in cmds]
+            print("\n".join(cmd_strs))
+            for cmd_str in cmd_strs:
+                command_output.append(b"dry-run")
+                command_output.append((">>> " + cmd_str).encode("utf-8", "surrogateescape"))
+            cmds = []
+        # parallel jobs start every command up front and then handle the results in order below
+        # this only applies when nothing needs to stop the job part way through
+        parallel_procs = []
+        if args.job and cmds:
+            verbosity = job_config.get("verbosity", "debug")
+            verbosity = verbosity if verbosity else "debug"
+            verbosity = verbosity.lower()
+        # an invalid verbosity runs the job in order instead, where it stops at the first command before anything runs
+        if args.job and job_config.get("parallel") and cmds and verbosity in ["debug", "info", "error", "silent"] and not (
+            interactive or args.error_interactive or job_config.get("exit_non_zero")
+        ):
+            import concurrent.futures
+            # commands running together cannot share the terminal's stdin, without -y they get none
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(cmds))) as executor:
+                parallel_procs = list(executor.map(
+                    lambda cmd: subprocess.run(
+                        cmd, stdin=None if args.yes else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        input=b"y\n" if args.yes else None
+                    ), cmds
+                ))
+        if args.job and cmds:
+            # these job settings are the same for every command, so they are looked up once
+            write_or_email = bool(
+                (job_config.get("write")) or
+                (isinstance(job_config.get("email"), dict) and job_config["email"].get("to"))
+            )
+            capture_output = write_or_email or bool(parallel_procs)
+            exit_non_zero = job_config.get("exit_non_zero")
+            proc_input = b"y\n" if args.yes else None
+            proc_out = subprocess.PIPE
+            proc_err = subprocess.PIPE
+            if not capture_output:
+                if verbosity in ["debug", "info"]:
+                    proc_out = sys.stdout
+                if verbosity in ["debug", "info", "error"]:
+                    proc_err = sys.stderr
+        for i, cmd in enumerate(cmds):
+            cmd_str = shlex.join(cmd)
             if args.job:
                 # run command as part of job, otherwise run command normally
-                capture_output = bool(
-                    (config.jobs[args.job].get("write")) or
-                    (isinstance(config.jobs[args.job].get("email"), dict) and config.jobs[args.job]["email"].get("to"))
-                )
-                verbosity = config.jobs[args.job].get("verbosity", "debug")
-                verbosity = verbosity if verbosity else "debug"
-                verbosity = verbosity.lower()
+                # checked here so the error names the command, like any other failure in the loop
                 assert verbosity in ["debug", "info", "error", "silent"]
                 if verbosity in ["debug"]:
-                    print("\033[94m%s\033[0m" % shlex.join(cmd))
-                if config.jobs[args.job].get("interactive"):
+                    print("\033[94m%s\033[0m" % cmd_str)
+                if interactive:
                     response = input("\033[92mContinue (yes/no/skip)?\033[0m ")
                     if response.strip().lower().startswith("y"):
                         pass
@@ -599,93 +929,112 @@ def main() -> int:
                     else:
                         print("\033[91mInvalid response, exiting\033[0m")
                         break
-                proc_input = b"y\n" if args.yes else None
-                proc_out = subprocess.PIPE
-                proc_err = subprocess.PIPE
-                if not capture_output:
+                if parallel_procs:
+                    # parallel output was captured in the background, show it now in order
+                    proc = parallel_procs[i]
                     if verbosity in ["debug", "info"]:
-                        proc_out = sys.stdout
+                        sys.stdout.buffer.write(proc.stdout)
                     if verbosity in ["debug", "info", "error"]:
-                        proc_err = sys.stderr
-                proc = subprocess.run(cmd, stdout=proc_out, stderr=proc_err, input=proc_input)
+                        sys.stderr.buffer.write(proc.stderr)
+                elif capture_output:
+                    proc = run_and_capture(cmd, proc_input, verbosity in ["debug", "info"], verbosity in ["debug", "info", "error"])
+                elif proc_input is None and proc_out is sys.stdout and proc_err is sys.stderr:
+                    # nothing to redirect or feed in, so it can be spawned directly like the other commands
+                    proc = run_command(cmd)
+                else:
+                    proc = subprocess.run(cmd, stdout=proc_out, stderr=proc_err, input=proc_input)
                 if proc.returncode != 0:
                     if args.error_interactive:
                         return_code += 1
-                        print(f"Error: exit {proc.returncode} for `{shlex.join(cmd)}`, continuing in interactive mode")
-                        config.jobs[args.job]["interactive"] = True
-                    elif config.jobs[args.job].get("exit_non_zero"):
+                        print(f"Error: exit {proc.returncode} for `{cmd_str}`, continuing in interactive mode")
+                        interactive = True
+                    elif exit_non_zero:
                         return_code = proc.returncode
-                        error_message = "Error: baka job encountered a non-zero exit code for `%s`, exiting" % shlex.join(cmd)
-                        command_output.append(error_message)
+                        error_message = "Error: baka job encountered a non-zero exit code for `%s`, exiting" % cmd_str
+                        command_output.append(error_message.encode("utf-8", "surrogateescape"))
                         print(error_message, file=sys.stderr)
                         break
                     else:
                         return_code += 1
                 if capture_output:
-                    if verbosity in ["debug", "info"]:
-                        sys.stdout.buffer.write(proc.stdout)
+                    # parallel output is only captured to show it in order, so it is separated like a normal run
                     if verbosity in ["debug", "info", "error"]:
-                        sys.stderr.buffer.write(proc.stderr)
-                        print("\n")
-                    command_output.append(">>> " + shlex.join(cmd))
-                    command_output.append(proc.stdout.decode().strip())
-                    command_output.append(proc.stderr.decode().strip())
-                    command_output.append("\n")
+                        print("\n" if write_or_email else "")
+                    command_output.append((">>> " + cmd_str).encode("utf-8", "surrogateescape"))
+                    command_output.append(proc.stdout.strip())
+                    command_output.append(proc.stderr.strip())
+                    command_output.append(b"\n")
                 elif verbosity in ["debug", "info", "error"]:
                     print("")
             elif args.file:
                 # save outputs of non-copy commands as files, otherwise run command normally
                 if cmd[0] == "BAKA_DEST":
+                    # stream output straight into the file instead of buffering and decoding it first
                     dest = cmd[1]
-                    with open(dest, "w", encoding="utf-8", errors="surrogateescape") as f:
-                        proc = subprocess.run(cmd[2:], capture_output=True, text=True)
-                        f.write(proc.stdout)
+                    with open(dest, "wb") as f:
+                        proc = subprocess.run(cmd[2:], stdout=f, stderr=subprocess.DEVNULL)
                 elif cmd[0] == "BAKA_STAT":
-                    with open(os.path.join(BASE_PATH, f"stat_{config.hostname}.json"), "w", encoding="utf-8", errors="surrogateescape") as json_file:
+                    with open_text(os.path.join(BASE_PATH, f"stat_{config.hostname}.json"), "w") as json_file:
                         json_file.write(cmd[1])
                 else:
-                    proc = subprocess.run(cmd)
+                    proc = run_command(cmd)
                 if proc.returncode != 0 and not (cmd[0] == "git" and cmd[1] == "commit"):
                     return_code += 1
             else:
                 # run command normally
-                if cmd == [sys.executable, os.path.abspath(__file__), "--_hash_and_copy_files"]:
-                    pending_stat = True
-                elif pending_stat:
-                    os_stat_tracked_files(config)
-                    pending_stat = False
-                proc = subprocess.run(cmd)
+                if tuple(cmd) == HASH_AND_COPY_FILES:
+                    # copy in this process instead of starting another python, the command is kept for --dry-run to show
+                    try:
+                        hash_and_copy_files(config)
+                        os_stat_tracked_files(config)
+                    except Exception as e:
+                        print("Error: copying tracked files failed %s %s" % (type(e).__name__, e.args), file=sys.stderr)
+                        return_code += 1
+                    continue
+                if args.diff and i == len(cmds) - 1 and return_code == 0:
+                    # nothing is logged after --diff, so let git replace this process for the final diff
+                    sys.stdout.flush()
+                    os.execvp(cmd[0], cmd)
+                proc = run_command(cmd)
                 if proc.returncode != 0 and not (cmd[0] == "git" and cmd[1] == "commit"):
                     return_code += 1
     except Exception as e:
         error_message = "Error baka line: %s For: %s %s %s" % (sys.exc_info()[2].tb_lineno, shlex.join(cmd), type(e).__name__, e.args)
-        command_output.append(error_message)
+        command_output.append(error_message.encode("utf-8", "surrogateescape"))
         print(error_message, file=sys.stderr)
     # 3. Append time and arguments to history.log, also log command output if job
     # append to history.log
     if not (args.dry_run or args.diff or args.log or args.show):
-        log_entry = time.ctime()
-        for key in vars(args):
-            if vars(args)[key] or (key == "remove" and args.remove is not None):
-                log_entry += " " + key + " " + str(vars(args)[key])
+        log_entry = [time.ctime()]
+        for key, value in vars(args).items():
+            if value or (key == "remove" and value is not None):
+                log_entry.append(f"{key} {value}")
         if error_message:
-            log_entry += " " + error_message
-        with open(os.path.join(BASE_PATH, "history.log"), "a", encoding="utf-8", errors="surrogateescape") as log_file:
-            log_file.write(log_entry + "\n")
+            log_entry.append(error_message)
+        log_entry = " ".join(log_entry)
+        # a single unbuffered append, no text file object needed for one line
+        log_fd = os.open(os.path.join(BASE_PATH, "history.log"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            os.write(log_fd, (log_entry + "\n").encode("utf-8", "surrogateescape"))
+        finally:
+            os.close(log_fd)
     # email or write command output
     if args.job:
-        command_output = "\n".join(command_output)
-        if isinstance(config.jobs[args.job].get("email"), dict) and config.jobs[args.job]["email"].get("to"):
+        command_output = b"\n".join(command_output)
+        if isinstance(job_config.get("email"), dict) and job_config["email"].get("to"):
+            email_body = command_output.decode("utf-8", "backslashreplace")
             try:
-                send_email(config.email, config.jobs[args.job]["email"], command_output)
+                with SMTPPool() as smtp_pool:
+                    smtp_pool.send(config.email, job_config["email"], email_body)
             except Exception as e:
-                error_email = "--- %s ---\nEmail Error: %s %s\nMessage:\n%s" % (time.ctime(), type(e).__name__, e.args, command_output)
-                with open(os.path.join(BASE_PATH, "error.log"), "a", encoding="utf-8", errors="surrogateescape") as log_file:
+                error_email = "--- %s ---\nEmail Error: %s %s\nMessage:\n%s" % (time.ctime(), type(e).__name__, e.args, email_body)
+                with open_text(os.path.join(BASE_PATH, "error.log"), "a") as log_file:
                     log_file.write(error_email + "\n")
-        if config.jobs[args.job].get("write"):
-            file_path = os.path.abspath(datetime.datetime.now().strftime(config.jobs[args.job]["write"]))
+        if job_config.get("write"):
+            import datetime
+            file_path = os.path.abspath(datetime.datetime.now().strftime(job_config["write"]))
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            with open(file_path, "w", encoding="utf-8", errors="backslashreplace") as f:
+            with open(file_path, "wb") as f:
                 f.write(command_output)
     return return_code
 